@@ -2,7 +2,11 @@
 """Generate tries from all giellatekno dictionaries, and store them in
 static/tries/, as gzipped, jsonified tries that will be used by the frontend.
 Additionally, create a metadata file src/lib/dict_metas.js with information
-about the dictionaries, such as the number of lemmas, file size, etc."""
+about the dictionaries, such as the number of lemmas, file size, etc., and
+a static/metas/xxx-yyy.json file per dictionary with the rest of the
+metadata (descriptions, etc.), which the frontend loads when needed, and
+src/lib/precache_manifest.js, which tells the service worker which tries to
+prefetch and cache."""
 
 # dictionary meta data structure:
 # s: file size of minified, uncompressed .xml file
@@ -11,6 +15,10 @@ about the dictionaries, such as the number of lemmas, file size, etc."""
 # h: sha1 hash of the minified .xml file
 # l1: language 1 (iso code)
 # l2: language 1 (iso code)
+#
+# and in the per-dictionary static/metas/xxx-yyy.json files:
+# public: if meta.xml says the dictionary is public
+# description: lang -> description, from meta.xml
 
 import argparse
 import concurrent.futures
@@ -27,7 +35,7 @@ from contextlib import contextmanager
 from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
-from time import perf_counter_ns
+from time import monotonic, perf_counter_ns, sleep
 from hashlib import sha1
 
 from trie import Trie
@@ -40,6 +48,10 @@ VALID_LANG = set([
     "sms", "som", "spa", "srs", "swe", "udm", "vep", "vot", "vro", "yrk",
 ])
 
+METAFILE = Path("./src/lib/dict_metas.js")
+METAS_DIR = Path("./static/metas")
+PRECACHE_MANIFEST = Path("./src/lib/precache_manifest.js")
+
 
 def warn(*msg):
     print("Warning: ", *msg, file=sys.stderr)
@@ -144,13 +156,21 @@ def logg(msg):
         print(f"{message} ({t:.2f}ms)")
 
 
+# two-letter language codes used in xml:lang attributes in meta.xml files
+ISO639_1_TO_3 = {
+    "da": "dan", "de": "deu", "en": "eng", "es": "spa", "et": "est",
+    "fi": "fin", "hu": "hun", "kl": "kal", "lv": "lav", "nb": "nob",
+    "no": "nob", "ro": "ron", "ru": "rus", "se": "sme", "so": "som",
+    "sv": "swe",
+}
+
+
 def langcode_to_3iso(langcode):
+    """Returns the 3-letter code of `langcode`, or `langcode` itself if we
+    don't know it (so that unknown languages don't end up on the same key)"""
     if len(langcode) == 3:
         return langcode
-    if langcode == "se":
-        return "sme"
-    elif langcode == "no":
-        return "nob"
+    return ISO639_1_TO_3.get(langcode, langcode)
 
 
 def find_gut_root():
@@ -335,11 +355,24 @@ def parse_gtxml_entry(e, lang2):
 
 
 class Metas:
+    """The meta data of all dictionaries, indexed by (lang1, lang2).
+
+    On disk, the small fields that the frontend needs up front (INDEX_KEYS)
+    are written to one index module, and everything else (such as the
+    descriptions from meta.xml) to one .json file per dictionary, which the
+    frontend only fetches when it needs it."""
+
+    INDEX_KEYS = ("l1", "l2", "h", "n", "cs", "ds", "f", "d")
+
     def __init__(self, data):
-        self.data = data
+        self.by_langs = {(meta["l1"], meta["l2"]): meta for meta in data}
+
+    @property
+    def data(self):
+        return list(self.by_langs.values())
 
     @classmethod
-    def from_metafile(cls, path):
+    def from_metafile(cls, path, details_dir=None):
         try:
             with open(path) as f:
                 file_contents = f.read()
@@ -348,31 +381,86 @@ class Metas:
         else:
             data = json.loads(file_contents[len("export default "):])
             assert isinstance(data, list)
+            if details_dir is not None:
+                for meta in data:
+                    details = details_dir / f"{meta['l1']}-{meta['l2']}.json"
+                    try:
+                        with open(details) as f:
+                            meta.update(json.load(f))
+                    except FileNotFoundError:
+                        pass
             return cls(data)
 
-    def write_metafile(self, path):
-        assert isinstance(self.data, list)
-        dump = json.dumps(self.data, separators=(",", ":"))
-        with open("src/lib/dict_metas.js", "w") as f:
+    def write_metafile(self, path, details_dir=None):
+        index = []
+        for meta in self.by_langs.values():
+            index.append({k: meta[k] for k in self.INDEX_KEYS if k in meta})
+            details = {k: v for k, v in meta.items() if k not in self.INDEX_KEYS}
+            if details_dir is None:
+                continue
+            filename = details_dir / f"{meta['l1']}-{meta['l2']}.json"
+            if details:
+                with open(filename, "w") as f:
+                    json.dump(details, f, separators=(",", ":"))
+            else:
+                # don't leave an outdated file behind
+                filename.unlink(missing_ok=True)
+
+        dump = json.dumps(index, separators=(",", ":"))
+        with open(path, "w") as f:
             f.write(f"export default {dump}")
 
     def find_by_langs(self, lang1, lang2):
-        for meta in self.data:
-            if meta["l1"] == lang1 and meta["l2"] == lang2:
-                return meta
+        return self.by_langs.get((lang1, lang2))
+
+    @classmethod
+    def clear_details(cls, meta):
+        """Remove everything but the INDEX_KEYS from `meta` (in place), so
+        that details from an earlier meta.xml don't outlive it."""
+        for key in meta.keys() - set(cls.INDEX_KEYS):
+            del meta[key]
 
     def find_by_ref(self, meta):
-        for m in self.data:
-            if meta is m:
-                return m
+        m = self.by_langs.get((meta.get("l1"), meta.get("l2")))
+        if meta is m:
+            return m
 
     def apply(self, other):
         """Merge in a meta object. That is, if other doesn't exist in our list,
-        then append it, otherwise do nothing. If other is None, do nothing."""
+        then add it, otherwise do nothing. If other is None, do nothing.
+        A meta object for the same pair of languages as one we already
+        have (such as one returned from another process) replaces it."""
         if other is not None:
             existing = self.find_by_ref(other)
             if not existing:
-                self.data.append(other)
+                self.by_langs[(other["l1"], other["l2"])] = other
+
+
+def write_precache_manifest(metas, path, first=(), budget=0):
+    """Write the list of tries the service worker should know about, with
+    their url, hash and (compressed) size, in the order they should be
+    prefetched: the pairs in `first` (in that order), then the rest by size,
+    smallest first. The service worker prefetches tries from the start of
+    the list until `budget` bytes would be exceeded."""
+    first = {langs: n for n, langs in enumerate(first)}
+
+    def priority(meta):
+        langs = (meta["l1"], meta["l2"])
+        return (langs not in first, first.get(langs), meta["cs"])
+
+    tries = [
+        {"url": f"tries/{meta['f']}", "h": meta["h"], "s": meta["cs"]}
+        for meta in sorted(metas.data, key=priority)
+    ]
+    dump = json.dumps({"budget": budget, "tries": tries}, separators=(",", ":"))
+    with open(path, "w") as f:
+        f.write(f"export default {dump}")
+
+
+def write_metafiles(metas, precache_first=(), precache_budget=0):
+    metas.write_metafile(METAFILE, METAS_DIR)
+    write_precache_manifest(metas, PRECACHE_MANIFEST, precache_first,
+                            precache_budget)
 
 
 def run_in_parallel(function, max_workers, dictionaries, metas):
@@ -441,15 +529,19 @@ def read_gt_dictionary(lang_src_directory):
     dict_meta = None
     file_list = []
 
-    for file in lang_src_directory.glob("*.xml"):
-        if file.name == "meta.xml":
-            dict_meta = process_meta_xml(file)
-            continue
-
+    # sorted, so that entries that occur in more than one file always
+    # come out in the same order (and thereby the trie gets the same hash)
+    for file in sorted(lang_src_directory.glob("*.xml")):
+        # meta.xml counts as well, so that a changed description is picked
+        # up even if none of the dictionary files changed
         modified_at = file.stat().st_mtime_ns / 1_000_000_000
         modified_at = datetime.fromtimestamp(modified_at)
         if modified_at > last_modified:
             last_modified = modified_at
+
+        if file.name == "meta.xml":
+            dict_meta = process_meta_xml(file)
+            continue
         file_list.append(file)
 
     return last_modified, dict_meta, file_list
@@ -461,24 +553,32 @@ def parse_gtdict(lang_src_folder, check_unique_lemmas=False, lang2=""):
     lemmas = defaultdict(list)
 
     for file in lang_src_folder:
-        root = ET.parse(file)
-        for e in root.iter("e"):
-            try:
-                lemma, pos, translations = parse_gtxml_entry(e, lang2=lang2)
-            except ValueError as err:
-                # something wrong when parsing this <e>, so we skip it
-                #s = ET.tostring(e, encoding="unicode")
-                #print(f"skipped (or failed) entry ({err}):\n{s}", file=sys.stderr)
-                continue
-            # if check_unique_lemmas and (lemma, pos) in lemmas:
-            #     other_file = lemmas[(lemma, pos)][0]
-            #     msg = f"warning: multiple <e> with same (lemma, pos): ({lemma}, {pos})"
-            #     if file == other_file:
-            #         msg += f" file: {file}"
-            #     else:
-            #         msg += f" file1: {other_file}, file2: {file}"
-            #     print(msg)
-            lemmas[(lemma, pos)].append(translations)
+        parse_gtdict_file(file, lemmas, lang2=lang2)
+
+    return lemmas
+
+
+def parse_gtdict_file(file, lemmas, lang2=""):
+    """Parses a single dictionary file, adding its entries to `lemmas`, a
+    dictionary of (lemma, pos) -> list of translation strings"""
+    root = ET.parse(file)
+    for e in root.iter("e"):
+        try:
+            lemma, pos, translations = parse_gtxml_entry(e, lang2=lang2)
+        except ValueError as err:
+            # something wrong when parsing this <e>, so we skip it
+            #s = ET.tostring(e, encoding="unicode")
+            #print(f"skipped (or failed) entry ({err}):\n{s}", file=sys.stderr)
+            continue
+        # if check_unique_lemmas and (lemma, pos) in lemmas:
+        #     other_file = lemmas[(lemma, pos)][0]
+        #     msg = f"warning: multiple <e> with same (lemma, pos): ({lemma}, {pos})"
+        #     if file == other_file:
+        #         msg += f" file: {file}"
+        #     else:
+        #         msg += f" file1: {other_file}, file2: {file}"
+        #     print(msg)
+        lemmas[(lemma, pos)].append(translations)
 
     return lemmas
 
@@ -524,12 +624,25 @@ def process_gtdict(lang1, lang2, dictionary_path, meta_entry):
         print(f"skipping ({lang1}, {lang2}) (not modified since last run)")
         return
 
+    Metas.clear_details(meta_entry)
+    if dict_meta is not None:
+        meta_entry.update(dict_meta)
+
     lemmas = parse_gtdict(xml_source_files, check_unique_lemmas=False, lang2=lang2)
 
     if not lemmas:
         print(f"no lemmas in ({lang1}, {lang2}), skipping")
         return
 
+    write_trie(lang1, lang2, lemmas, last_modified, meta_entry)
+
+    print(f"done processing {lang1}-{lang2}")
+    return meta_entry
+
+
+def write_trie(lang1, lang2, lemmas, last_modified, meta_entry):
+    """Build the trie from `lemmas`, write it to static/tries/, and update
+    `meta_entry` (in place) to describe the written file."""
     trie = lemmas_into_trie(lemmas)
     json_bytes = trie.into_json().encode("utf-8")
     gzipped_bytes = gzip.compress(json_bytes)
@@ -549,8 +662,169 @@ def process_gtdict(lang1, lang2, dictionary_path, meta_entry):
         "l2": lang2,
     })
 
-    print(f"done processing {lang1}-{lang2}")
-    return meta_entry
+
+class WatchedDictionary:
+    """A dictionary that is kept parsed in memory, one set of lemmas per
+    source file, so that only the files that change have to be parsed again.
+    """
+
+    def __init__(self, lang1, lang2, src_dir):
+        self.lang1 = lang1
+        self.lang2 = lang2
+        self.src_dir = src_dir
+        # path -> st_mtime_ns, as of the last time we looked
+        self.mtimes = {}
+        # path -> (lemma, pos) -> list of translation strings
+        self.parsed = {}
+        # the contents of meta.xml, as returned by process_meta_xml()
+        self.dict_meta = None
+
+    def scan(self):
+        """Returns path -> st_mtime_ns of all the .xml files currently in
+        the src/ directory (meta.xml included)."""
+        mtimes = {}
+        for file in self.src_dir.glob("*.xml"):
+            try:
+                mtimes[file] = file.stat().st_mtime_ns
+            except FileNotFoundError:
+                # removed between glob() and stat()
+                continue
+        return mtimes
+
+    def poll(self):
+        """Returns the set of files that were added, changed or removed since
+        the last time we polled."""
+        mtimes = self.scan()
+        changed = {
+            file for file, mtime in mtimes.items()
+            if self.mtimes.get(file) != mtime
+        }
+        changed |= self.mtimes.keys() - mtimes.keys()
+        self.mtimes = mtimes
+        return changed
+
+    def reparse(self, files):
+        """Parse `files` again, forgetting the ones that no longer exist."""
+        for file in files:
+            if file.name == "meta.xml":
+                self.reparse_meta(file)
+                continue
+            if file not in self.mtimes:
+                self.parsed.pop(file, None)
+                continue
+            lemmas = defaultdict(list)
+            try:
+                parse_gtdict_file(file, lemmas, lang2=self.lang2)
+            except ET.ParseError as e:
+                # probably saved halfway through an edit, keep the old
+                # result around until the file is valid again
+                warn(f"{file}: {e}")
+                continue
+            self.parsed[file] = lemmas
+
+    def reparse_meta(self, file):
+        if file not in self.mtimes:
+            self.dict_meta = None
+            return
+        try:
+            self.dict_meta = process_meta_xml(file)
+        except (ET.ParseError, AttributeError) as e:
+            # halfway through an edit (such as an empty <public>), keep
+            # the previous contents until it's valid again
+            warn(f"{file}: {e}")
+
+    def lemmas(self):
+        """All lemmas of this dictionary, with the files merged in
+        filename order."""
+        lemmas = defaultdict(list)
+        for file in sorted(self.parsed):
+            for key, translations in self.parsed[file].items():
+                lemmas[key].extend(translations)
+        return lemmas
+
+    def last_modified(self):
+        """Same as read_gt_dictionary(): the time the most recently modified
+        .xml file (meta.xml included) was modified."""
+        if not self.mtimes:
+            return datetime.fromtimestamp(0)
+        return datetime.fromtimestamp(max(self.mtimes.values()) / 1_000_000_000)
+
+    def rebuild(self, metas):
+        lemmas = self.lemmas()
+        if not lemmas:
+            print(f"no lemmas in ({self.lang1}, {self.lang2}), skipping")
+            return
+        meta_entry = metas.find_by_langs(self.lang1, self.lang2)
+        if meta_entry is None:
+            meta_entry = {}
+        Metas.clear_details(meta_entry)
+        if self.dict_meta is not None:
+            meta_entry.update(self.dict_meta)
+        write_trie(self.lang1, self.lang2, lemmas, self.last_modified(),
+                   meta_entry)
+        metas.apply(meta_entry)
+
+
+def watch(dictionaries, metas, interval=0.2, settle=0.3, **write_args):
+    """Keep all `dictionaries` parsed in memory, and rebuild the trie and
+    the metafile of a dictionary whenever one of its source files changes.
+
+    The src/ directories are polled every `interval` seconds. A dictionary
+    is rebuilt once no more changes to it have been seen for `settle`
+    seconds, so a burst of saves only results in one rebuild. `write_args`
+    are passed on to write_metafiles()."""
+    watched = {}
+    for (lang1, lang2), dictionary_path in dictionaries.items():
+        src_dir = dictionary_path / "src"
+        if not src_dir.is_dir():
+            warn(f"When watching dictionary ({lang1}, {lang2}): dictionary "
+                 "has no src/ folder")
+            continue
+        with logg(f"parsing {lang1}-{lang2}"):
+            wd = WatchedDictionary(lang1, lang2, src_dir)
+            wd.reparse(wd.poll())
+        watched[(lang1, lang2)] = wd
+
+    print(f"watching {len(watched)} dictionaries for changes "
+          "(ctrl+c to stop)")
+
+    # (lang1, lang2) -> set of changed files
+    pending = defaultdict(set)
+    # (lang1, lang2) -> when we last saw a change to that dictionary
+    last_change = {}
+    try:
+        while True:
+            sleep(interval)
+            for langs, wd in watched.items():
+                if changed := wd.poll():
+                    pending[langs] |= changed
+                    last_change[langs] = monotonic()
+
+            now = monotonic()
+            settled = [
+                langs for langs in pending
+                if now - last_change[langs] >= settle
+            ]
+            if not settled:
+                continue
+
+            for lang1, lang2 in settled:
+                files = pending.pop((lang1, lang2))
+                wd = watched[(lang1, lang2)]
+                with logg(f"rebuilding {lang1}-{lang2} "
+                          f"({len(files)} file(s) changed)") as l:
+                    try:
+                        wd.reparse(files)
+                        wd.rebuild(metas)
+                    except OSError as e:
+                        l.done("failed")
+                        warn(f"rebuilding ({lang1}, {lang2}) failed: {e}")
+            try:
+                write_metafiles(metas, **write_args)
+            except OSError as e:
+                warn(f"writing the metafiles failed: {e}")
+    except KeyboardInterrupt:
+        print("Stopped watching")
 
 
 def parse_args():
@@ -558,6 +832,16 @@ def parse_args():
     parser.add_argument("--clean", action="store_true")
     parser.add_argument("--ncpus", action=NCpus)
     parser.add_argument("--only")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, and rebuild dictionaries when "
+                             "their source files change")
+    parser.add_argument("--precache-first", default="",
+                        help="comma separated list of language pairs (such "
+                             "as smenob,nobsme) the service worker should "
+                             "prefetch before any other")
+    parser.add_argument("--precache-budget", type=float, default=5,
+                        help="how many megabytes of tries the service worker "
+                             "may prefetch in the background (default: 5)")
     # parser.add_argument("--check-unique-lemmas", action="store_true")
 
     args = parser.parse_args()
@@ -565,6 +849,21 @@ def parse_args():
     if args.only:
         args.only = set(args.only.split(","))
 
+    precache_first = []
+    for langpair in args.precache_first.split(","):
+        if not langpair:
+            continue
+        lang1, lang2 = langpair[0:3], langpair[3:]
+        if (lang1 not in VALID_LANG) or (lang2 not in VALID_LANG):
+            parser.error(
+                f"argument '--precache-first': invalid language pair "
+                f"'{langpair}' (expected two 3-letter language codes, "
+                "such as smenob)"
+            )
+        precache_first.append((lang1, lang2))
+    args.precache_first = precache_first
+    args.precache_budget = int(args.precache_budget * 1_000_000)
+
     return args
 
 
@@ -573,11 +872,14 @@ def main():
 
     if args.clean:
         run("rm -f static/tries/*", echo=True)
+        run("rm -f static/metas/*", echo=True)
         run("rm -f src/lib/dict_metas.js", echo=True)
+        run("rm -f src/lib/precache_manifest.js", echo=True)
         exit(0)
 
-    metas = Metas.from_metafile(Path("./src/lib/dict_metas.js"))
+    metas = Metas.from_metafile(METAFILE, METAS_DIR)
     Path("./static/tries").mkdir(parents=True, exist_ok=True)
+    METAS_DIR.mkdir(parents=True, exist_ok=True)
 
     t0 = perf_counter_ns()
     dictionaries = dict(find_gt_dictionaries())
@@ -594,6 +896,15 @@ def main():
                      "this system.")
         dictionaries = only_dicts
 
+    write_args = {
+        "precache_first": args.precache_first,
+        "precache_budget": args.precache_budget,
+    }
+
+    if args.watch:
+        watch(dictionaries, metas, **write_args)
+        return
+
     if args.ncpus == 1:
         for (lang1, lang2), dictionary_path in dictionaries.items():
             meta = metas.find_by_langs(lang1, lang2)
@@ -602,7 +913,7 @@ def main():
     else:
         run_in_parallel(process_gtdict, args.ncpus, dictionaries, metas)
 
-    metas.write_metafile(Path("./src/lib/dict_metas.js"))
+    write_metafiles(metas, **write_args)
 
     t1 = perf_counter_ns()
     t = (t1 - t0) // 1_000_000_000
@@ -1,34 +1,180 @@
 import argparse
+import concurrent.futures
+import heapq
+import json
 import sys
+import tempfile
 from collections import defaultdict
+from itertools import groupby
 from pathlib import Path
+from time import perf_counter_ns
 import xml.etree.ElementTree as ET
 
+from generate_meta import NCpus
+
+# how many sorted runs to merge at the same time, when doing the external
+# merge in --stream mode (each run is an open file)
+MERGE_FAN_IN = 64
+
+
+def read_entry(entry):
+    """Returns lemma, {"pos": ..., "translations": [...]} of an <e>"""
+    lemmas = entry.findall("lg/l")
+    assert len(lemmas) == 1, "only 1 <l> in an <lg>"
+    lemma = lemmas[0]
+    translations = []
+    for mg in entry.findall("mg"):
+        for tg in mg.findall("tg"):
+            for t in tg.findall("t"):
+                text = t.text
+                if text:
+                    translations.append({"pos": t.get("pos"), "t": t.text})
+
+    return lemma.text, {
+        "pos": lemma.get("pos"),
+        "translations": translations,
+    }
+
 
 def read_file(path, words):
     tree = ET.parse(path)
     root = tree.getroot()
     for entry in root.iter("e"):
-        lemmas = entry.findall("lg/l")
-        assert len(lemmas) == 1, "only 1 <l> in an <lg>"
-        lemma = lemmas[0]
-        translations = []
-        for mg in entry.findall("mg"):
-            for tg in mg.findall("tg"):
-                for t in tg.findall("t"):
-                    text = t.text
-                    if text:
-                        translations.append({"pos": t.get("pos"), "t": t.text})
-
-        words[lemma.text].append({
-            "pos": lemma.get("pos"),
-            "translations": translations,
-        })
+        lemma, word = read_entry(entry)
+        words[lemma].append(word)
+
+
+def format_word(word, translations, fmt):
+    if fmt == "jsonl":
+        obj = {"word": word, "entries": translations}
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    col2 = ""
+    for tr in translations:
+        col2 += ", ".join(t["t"] for t in tr["translations"])
+    return f"{word}\t{col2}"
+
+
+def sort_key(word):
+    """Words are sorted by their string form, which puts a missing lemma
+    (None) among the words starting with "None", same as a plain sort of the
+    tsv lines would do."""
+    return str(word)
+
+
+def record_key(rec):
+    return sort_key(rec[0]), rec[1], rec[2]
+
+
+def write_run(file_no, path, tmpdir):
+    """Parse one file, and write its entries, sorted, to a run file in
+    `tmpdir`. The <e> elements are dropped from the tree as they are read,
+    so memory use is bounded by the entries of one file, not its tree.
+    Returns (path of run file, number of entries, bytes read)"""
+    records = []
+    entry_no = 0
+    # the elements currently open, so that a finished <e> can be removed
+    # from its parent
+    stack = []
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag != "e":
+            continue
+        lemma, word = read_entry(elem)
+        if stack:
+            stack[-1].remove(elem)
+        # file_no and entry_no keep the original order of words that
+        # occur more than once
+        records.append((lemma, file_no, entry_no, word))
+        entry_no += 1
+    records.sort(key=record_key)
+
+    run_path = Path(tmpdir) / f"{file_no}.run"
+    with open(run_path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False))
+            f.write("\n")
+    return run_path, len(records), path.stat().st_size
+
+
+def read_run(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def merge_runs(runs, tmpdir):
+    """Merge the sorted runs, at most MERGE_FAN_IN at a time, until there
+    are few enough left to merge in one go. Returns an iterator over all
+    records, in sorted order."""
+    level = 0
+    while len(runs) > MERGE_FAN_IN:
+        merged = []
+        for i in range(0, len(runs), MERGE_FAN_IN):
+            batch = runs[i:i + MERGE_FAN_IN]
+            run_path = Path(tmpdir) / f"merge-{level}-{i}.run"
+            with open(run_path, "w", encoding="utf-8") as f:
+                for rec in heapq.merge(*map(read_run, batch),
+                                       key=record_key):
+                    f.write(json.dumps(rec, ensure_ascii=False))
+                    f.write("\n")
+            for path in batch:
+                path.unlink()
+            merged.append(run_path)
+        runs = merged
+        level += 1
+
+    return heapq.merge(*map(read_run, runs), key=record_key)
+
+
+def stream_export(files, out, fmt, ncpus):
+    """Parse all files in parallel, and write them sorted to `out`, without
+    ever having all of the words in memory at once."""
+    t0 = perf_counter_ns()
+    n_entries = n_words = n_bytes = 0
+
+    with tempfile.TemporaryDirectory(prefix="read_gtdict-") as tmpdir:
+        runs = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(ncpus, 1)) as pool:
+            futures = [
+                pool.submit(write_run, file_no, path, tmpdir)
+                for file_no, path in enumerate(files)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                run_path, entries, size = future.result()
+                runs.append(run_path)
+                n_entries += entries
+                n_bytes += size
+
+        records = merge_runs(runs, tmpdir)
+        for word, group in groupby(records, key=lambda rec: rec[0]):
+            translations = [rec[3] for rec in group]
+            out.write(format_word(word, translations, fmt))
+            out.write("\n")
+            n_words += 1
+
+    t = max((perf_counter_ns() - t0) / 1_000_000_000, 1e-9)
+    mb = n_bytes / 1_000_000
+    print(f"exported {n_words} words ({n_entries} entries) from "
+          f"{len(files)} files ({mb:.2f}MB) in {t:.2f}s: "
+          f"{mb / t:.2f}MB/s, {n_entries / t:.0f} entries/s",
+          file=sys.stderr)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("input", help="src folder or a single xml file")
+    parser.add_argument("--format", choices=("tsv", "jsonl"), default="tsv",
+                        help="output format (default: tsv)")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse files in parallel, and sort the output "
+                             "on disk instead of in memory")
+    parser.add_argument("--output", "-o", type=Path,
+                        help="write to this file instead of stdout")
+    parser.add_argument("--ncpus", action=NCpus)
 
     args = parser.parse_args()
 
@@ -47,21 +193,27 @@ def handle_args(args):
 
 
 def main():
-    files = handle_args(parse_args())
-
-    words = defaultdict(list)
-    for f in files:
-        read_file(f, words)
-
-    lines = []
-    for word, translations in words.items():
-        col2 = ""
-        for tr in translations:
-            col2 += ", ".join(t["t"] for t in tr["translations"])
-        lines.append(f'{word}\t{col2}')
-    lines.sort()
-    for line in lines:
-        print(line)
+    args = parse_args()
+    files = handle_args(args)
+
+    out = sys.stdout
+    if args.output:
+        out = open(args.output, "w", encoding="utf-8")
+
+    try:
+        if args.stream:
+            stream_export(files, out, args.format, args.ncpus)
+            return
+
+        words = defaultdict(list)
+        for f in files:
+            read_file(f, words)
+
+        for word in sorted(words, key=sort_key):
+            print(format_word(word, words[word], args.format), file=out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import { gunzip, gzip } from "$lib/utils.js";
+import { debug } from "$lib/debug_console.js";
+import { IDB } from "$lib/idb.js";
+
+// the saved dictionaries. this is kept apart from dictionary.js, so that
+// the service worker can use it too
+
+const DATABASE_SPEC = {
+    name: "dictionaries",
+    version: 2,
+    stores: {
+        // copy of the meta-data for the dict, keyed by hash
+        metas: { keyPath: "h" },
+        // no the gzipped xml data, keyed out-of-line by hash
+        blobs: {},
+    },
+};
+
+const DATABASE = new IDB(DATABASE_SPEC);
+
+export async function delete_database() {
+    await DATABASE.delete_database();
+}
+
+// Get the dictionary in the idb for this meta,
+// return arraybuffer of decompressed data on success, or
+// undefined if the corresponding data for the 'meta' was not found
+export async function get_from_indexeddb(meta) {
+    debug("enter get_from_indexeddb()", meta);
+    return await DATABASE.transaction(
+        ["metas", "blobs"],
+        "readonly",
+        async ([metastore, blobstore]) => {
+            const blob = await blobstore.get(meta.h);
+            if (blob === undefined) {
+                return undefined;
+            } else {
+                debug("return from get_from_indexeddb()");
+                return await gunzip(blob);
+            }
+        }
+    );
+}
+
+// Save (or replace) the dictionary for this meta. Dictionaries that the
+// service worker prefetches are saved with { prefetched: true }, so that
+// they are not listed as saved by the user.
+export async function save_to_indexeddb(meta, buffer, { prefetched = false } = {}) {
+    // compress before the transaction starts, as it would otherwise be
+    // committed while we wait for it
+    const blob = await gzip(buffer);
+    await DATABASE.transaction(
+        ["metas", "blobs"],
+        "readwrite",
+        async ([metastore, blobstore]) => {
+            await metastore.put({ ...meta, prefetched });
+            await blobstore.put(blob, { key: meta.h });
+        },
+    );
+}
+
+export async function delete_from_indexeddb(hash) {
+    return await DATABASE.transaction(
+        ["metas", "blobs"],
+        "readwrite",
+        async ([metastore, blobstore]) => {
+            await blobstore.delete(hash);
+            // metas are keyed by hash too
+            await metastore.delete(hash);
+        },
+    );
+}
+
+// list all dictionaries we have saved, not counting the ones the service
+// worker prefetched, unless `include_prefetched` is given
+export async function saved_dictionaries({ include_prefetched = false } = {}) {
+    return await DATABASE.transaction(
+        ["metas"],
+        "readonly",
+        async ([metastore]) => {
+            const all = await metastore.get_all();
+            const objects = all.map(([_key, object]) => object);
+            if (include_prefetched) {
+                return objects;
+            }
+            return objects.filter(object => !object.prefetched);
+        }
+    );
+}
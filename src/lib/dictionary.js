@@ -1,25 +1,35 @@
-import { gzip, gunzip, min } from "$lib/utils.js";
-import { debug } from "$lib/debug_console.js";
-import { IDB } from "$lib/idb.js";
+import { base } from "$app/paths";
 import METAS from "$lib/dict_metas.js";
 
-const DATABASE_SPEC = {
-    name: "dictionaries",
-    version: 2,
-    stores: {
-        // copy of the meta-data for the dict, keyed by hash
-        metas: { keyPath: "h" },
-        // no the gzipped xml data, keyed out-of-line by hash
-        blobs: {},
-    },
-};
-
-const DATABASE = new IDB(DATABASE_SPEC);
+export {
+    delete_database,
+    get_from_indexeddb,
+    save_to_indexeddb,
+    delete_from_indexeddb,
+    saved_dictionaries,
+} from "$lib/database.js";
 
 export function get_meta(lang1, lang2) {
     return METAS.find(m => m.l1 === lang1 && m.l2 === lang2);
 }
 
+// the rest of the meta data for a dictionary (description, etc), which is
+// not in dict_metas.js, but in a separate file per dictionary, so that it's
+// only fetched for the dictionaries that are actually used
+const DETAILS = new Map();
+
+export async function get_meta_details(lang1, lang2) {
+    const key = `${lang1}-${lang2}`;
+    if (!DETAILS.has(key)) {
+        const details = fetch(`${base}/metas/${key}.json`)
+            .then(response => response.ok ? response.json() : {});
+        // don't remember failures, so that we can try again later
+        details.catch(() => DETAILS.delete(key));
+        DETAILS.set(key, details);
+    }
+    return { ...get_meta(lang1, lang2), ...await DETAILS.get(key) };
+}
+
 export function total_lemmas(lang) {
     return METAS
         .filter(m => m.l1 === lang)
@@ -27,62 +37,10 @@ export function total_lemmas(lang) {
         .reduce((acc, cur) => acc + cur, 0);
 }
 
-export async function delete_database() {
-    await DATABASE.delete_database();
-}
-
-// Get the dictionary in the idb for this meta,
-// return arraybuffer of decompressed data on success, or
-// undefined if the corresponding data for the 'meta' was not found
-export async function get_from_indexeddb(meta) {
-    debug("enter get_from_indexeddb()", meta);
-    return await DATABASE.transaction(
-        ["metas", "blobs"],
-        "readonly",
-        async ([metastore, blobstore]) => {
-            const blob = await blobstore.get(meta.h);
-            if (blob === undefined) {
-                return undefined;
-            } else {
-                debug("return from get_from_indexeddb()");
-                return await gunzip(blob);
-            }
-        }
-    );
-}
-
-export async function save_to_indexeddb(meta, buffer, { allow_replace = false } = {}) {
-    await DATABASE.transaction(
-        ["metas", "blobs"],
-        "readwrite",
-        async ([metastore, blobstore]) => {
-            await metastore.add({ ...meta }, { allow_replace });
-            await blobstore.add(await gzip(buffer), { key: meta.h, allow_replace });
-        },
-    );
-}
-
-export async function delete_from_indexeddb(hash) {
-    return await DATABASE.transaction(
-        ["metas", "blobs"],
-        "readwrite",
-        async ([metastore, blobstore]) => {
-            throw new Error("unimplemented");
-            //await blobstore.delete(hash);
-            //await metastore.delete(...);
-        },
-    );
-}
-
-// list all dictionaries we have saved
-export async function saved_dictionaries() {
-    return await DATABASE.transaction(
-        ["metas"],
-        "readonly",
-        async ([metastore]) => {
-            const all = await metastore.get_all();
-            const objects = all.map(([_key, object]) => object);
-            return objects;
-        }
-    );
+// ask the service worker to prefetch dictionaries in the background. `skip`
+// is the hash of the dictionary being shown, which the page saves itself
+export async function request_prefetch(skip) {
+    if (!("serviceWorker" in navigator)) return;
+    const registration = await navigator.serviceWorker.ready;
+    registration.active?.postMessage({ type: "prefetch-tries", skip });
 }
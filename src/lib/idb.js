@@ -9,7 +9,7 @@ import { debug } from "$lib/debug_console.js";
 //
 export class IDB {
     constructor(spec) {
-        if (typeof window === "undefined") {
+        if (typeof indexedDB === "undefined") {
             // sveltekit runs this on the server
             return;
         }
@@ -18,7 +18,8 @@ export class IDB {
         this.queue = [];
 
         this.database = new Promise((resolve, reject) => {
-            const req = window.indexedDB.open(
+            // not window.indexedDB, the service worker uses this too
+            const req = indexedDB.open(
                 this.spec.name, this.spec.version);
             req.onupgradeneeded = ev => {
                 console.log("upgradeneeded");
@@ -140,6 +141,15 @@ class ObjectStore {
         });
     }
 
+    // add an object to this store, replacing any object with the same key
+    put(object, { key } = {}) {
+        return new Promise((resolve, reject) => {
+            const request = this._store.put(object, key);
+            request.onsuccess = ev => resolve();
+            request.onerror = ev => reject(ev.target.error);
+        });
+    }
+
     get(key) {
         debug(`store.get(key) [store=${this.name}], key = `, key);
         return new Promise((resolve, reject) => {
@@ -223,7 +233,7 @@ class ObjectStore {
 
 function _delete_database(name) {
     return new Promise((resolve, reject) => {
-        const request = window.indexedDB
+        const request = indexedDB
             .deleteDatabase(name);
         console.log("request sent to delete database..");
         request.onsuccess = ev => {
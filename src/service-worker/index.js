@@ -5,7 +5,16 @@
 
 const sw = /** @type {ServiceWorkerGlobalScope} */ (/** @type {unknown} */ (self));
 
-import { build, files, version } from "$service-worker";
+import { base, build, files, version } from "$service-worker";
+import { gunzip } from "$lib/utils.js";
+import {
+    delete_from_indexeddb,
+    get_from_indexeddb,
+    save_to_indexeddb,
+    saved_dictionaries,
+} from "$lib/database.js";
+import METAS from "$lib/dict_metas.js";
+import PRECACHE from "$lib/precache_manifest.js";
 
 const CACHE = `cache-${version}`;
 
@@ -25,6 +34,70 @@ async function activate() {
     console.log("service worker activated");
 }
 
+async function fetch_trie(url) {
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`${response.status} response`);
+    }
+    // the browser gunzips it for us if "Content-Encoding: gzip" is set
+    const content_encoding = response.headers.get("content-encoding");
+    const buffer = await response.arrayBuffer();
+    if (content_encoding && content_encoding.toLowerCase() === "gzip") {
+        return buffer;
+    }
+    return await gunzip(buffer);
+}
+
+// Tries are saved in the same indexeddb as the pages save them to, keyed by
+// hash, so a trie is only fetched if we don't already have that version of
+// it. They are marked as prefetched, so that they are not shown as saved by
+// the user. Tries we prefetched earlier, that are not the current version of
+// any dictionary, are deleted (the ones the user saved are left alone), then
+// the tries at the start of the manifest (the ones that it wants to be
+// available first) are fetched, until the byte budget is used.
+// `skip` is the hash of a trie not to fetch (the page that asked for the
+// prefetch is showing it, and saves it itself).
+async function prefetch_tries(skip) {
+    const current = new Map(METAS.map(meta => [meta.h, meta]));
+
+    const saved = await saved_dictionaries({ include_prefetched: true });
+    for (const meta of saved) {
+        if (meta.prefetched && !current.has(meta.h)) {
+            await delete_from_indexeddb(meta.h);
+        }
+    }
+
+    let used = 0;
+    for (const entry of PRECACHE.tries) {
+        used += entry.s;
+        if (used > PRECACHE.budget) break;
+
+        const meta = current.get(entry.h);
+        if (meta === undefined || entry.h === skip) continue;
+        if (await get_from_indexeddb(meta)) continue;
+
+        try {
+            const buffer = await fetch_trie(`${base}/${entry.url}`);
+            // a page may have saved it while we were downloading it
+            if (await get_from_indexeddb(meta)) continue;
+            await save_to_indexeddb(meta, buffer, { prefetched: true });
+        } catch (e) {
+            // offline or such, it will be fetched when it's needed instead
+            console.log(`prefetching ${entry.url} failed`, e);
+        }
+    }
+}
+
+// only one prefetch at a time, no matter how many pages ask for it
+let prefetching = null;
+
+function prefetch(skip) {
+    if (prefetching === null) {
+        prefetching = prefetch_tries(skip).finally(() => prefetching = null);
+    }
+    return prefetching;
+}
+
 // all fetch() calls from the site goes through this
 async function proxy_fetch(request) {
     const url = new URL(request.url);
@@ -40,6 +113,13 @@ async function proxy_fetch(request) {
 
 sw.addEventListener("install", event => event.waitUntil(install()));
 sw.addEventListener("activate", event => event.waitUntil(activate()));
+// a dictionary page asks for the prefetch once its own dictionary is ready,
+// so that it runs in the background, doesn't compete with the download the
+// user is waiting for, and doesn't hold up installing or activating
+sw.addEventListener("message", event => {
+    const { type, skip } = event.data ?? {};
+    if (type === "prefetch-tries") event.waitUntil(prefetch(skip));
+});
 sw.addEventListener("fetch", event => {
     const request = event.request;
     if (request.method !== "GET") return;